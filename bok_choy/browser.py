@@ -3,23 +3,17 @@ Use environment variables to configure Selenium remote WebDriver.
 For use with SauceLabs (via SauceConnect) or local browsers.
 """
 
+import atexit
 import errno
+import importlib
 import logging
 import os
+import threading
+import weakref
+from concurrent import futures
 from json import dumps
 from shutil import copyfile
 
-try:
-    from needle.driver import (
-        NeedleChrome as Chrome,
-        NeedleFirefox as Firefox,
-        NeedleIe as Ie,
-        NeedleOpera as Opera,
-        NeedlePhantomJS as PhantomJS,
-        NeedleSafari as Safari
-    )
-except ImportError:
-    from selenium.webdriver import Chrome, Firefox, Ie, Opera, PhantomJS, Safari
 from selenium import webdriver
 from selenium.common.exceptions import WebDriverException
 from selenium.webdriver.chrome.options import Options as ChromeOptions
@@ -50,14 +44,38 @@ OPTIONAL_ENV_VARS = [
     'SELENIUM_INSECURE_CERTS',
 ]
 
+# Sets of the variables which must all be set to use a remote browser, for _use_remote_browser()
+_REMOTE_ENV_VAR_SET = frozenset(REMOTE_ENV_VARS)
+_SAUCE_ENV_VAR_SET = frozenset(SAUCE_ENV_VARS)
+
+# Every environment variable consulted when configuring a remote browser
+_REMOTE_CONFIG_ENV_VARS = tuple(SAUCE_ENV_VARS + OPTIONAL_ENV_VARS)
+
+
+# Names of the selenium.webdriver classes for local browsers; the Needle subclass
+# (with the same name prefixed by "Needle") is used instead if it is installed
+_BROWSER_FACTORIES = {
+    'chrome': 'Chrome',
+    'firefox': 'Firefox',
+    'internet explorer': 'Ie',
+    'opera': 'Opera',
+    'phantomjs': 'PhantomJS',
+    'safari': 'Safari',
+}
+
+# Local browser classes which have already been imported, keyed by browser name
+_BROWSER_CLASSES = {}
+
+_BROWSERS_OPTIONS_STR = ", ".join(_BROWSER_FACTORIES)
 
-BROWSERS = {
-    'chrome': Chrome,
-    'firefox': Firefox,
-    'internet explorer': Ie,
-    'opera': Opera,
-    'phantomjs': PhantomJS,
-    'safari': Safari,
+# Desired capabilities which are the same for every remote browser
+_BASE_CAPS = {
+    'video-upload-on-pass': False,
+    'sauce-advisor': False,
+    'capture-html': True,
+    'record-screenshots': True,
+    'max-duration': 600,
+    'public': 'public restricted',
 }
 
 FIREFOX_PROFILE_ENV_VAR = 'FIREFOX_PROFILE_PATH'
@@ -65,6 +83,62 @@ FIREFOX_PROFILE_ENV_VAR = 'FIREFOX_PROFILE_PATH'
 # A list of functions accepting one FirefoxProfile argument
 FIREFOX_PROFILE_CUSTOMIZERS = []
 
+# Environment variables which change how a local browser is launched
+_LOCAL_ENV_VARS = (
+    'BOKCHOY_HEADLESS',
+    FIREFOX_PROFILE_ENV_VAR,
+    'SELENIUM_FIREFOX_PATH',
+    'SELENIUM_FIREFOX_LOG',
+)
+
+# Idle browsers handed back via release_browser(), keyed by the configuration they were launched with
+_BROWSER_POOL = {}
+_BROWSER_POOL_LOCK = threading.Lock()
+
+# The pool key of every browser launched by browser()
+_BROWSER_POOL_KEYS = weakref.WeakKeyDictionary()
+
+
+def _max_concurrent_startups():
+    """
+    Returns how many browsers may be launched at once, from the
+    BOKCHOY_MAX_CONCURRENT_STARTUPS environment variable (default 1).
+    """
+    value = os.environ.get('BOKCHOY_MAX_CONCURRENT_STARTUPS', '1')
+    try:
+        count = int(value)
+    except ValueError:
+        count = 0
+    if count < 1:
+        LOGGER.warning(
+            "BOKCHOY_MAX_CONCURRENT_STARTUPS must be a positive integer, not %r; launching one browser at a time",
+            value
+        )
+        return 1
+    return count
+
+
+# Limits how many browsers this process launches at once, since concurrent startups
+# slow each other down enough to time out on CPU-constrained CI machines
+_STARTUP_SEMAPHORE = threading.Semaphore(_max_concurrent_startups())
+
+# Fetches and writes the logs requested by save_driver_logs() in the background.
+# Selenium offers no per-request timeout, so a fetch from a driver which never
+# responds occupies a worker until the driver is quit; the interpreter waits for
+# it at exit, so such drivers are quit rather than pooled by release_browser().
+_DRIVER_LOG_EXECUTOR = futures.ThreadPoolExecutor(max_workers=4, thread_name_prefix='bok_choy_driver_logs')
+
+# (driver, log type, future) tuples for the driver logs requested without waiting
+# which flush_driver_logs() hasn't waited for yet
+_PENDING_DRIVER_LOGS = []
+_PENDING_DRIVER_LOGS_LOCK = threading.Lock()
+
+# The log types each browser failed to provide in time, which aren't requested from it again
+_UNSUPPORTED_LOG_TYPES = weakref.WeakKeyDictionary()
+
+# Default number of seconds flush_driver_logs() waits for the driver logs
+DRIVER_LOG_TIMEOUT = 5
+
 
 class BrowserConfigError(Exception):
 
@@ -127,9 +201,8 @@ def save_screenshot(driver, name):
         if not screenshot_dir:
             LOGGER.warning('The SCREENSHOT_DIR environment variable was not set; not saving a screenshot')
             return
-        if not os.path.exists(screenshot_dir):
-            os.makedirs(screenshot_dir)
-        image_name = os.path.join(screenshot_dir, name + '.png')
+        os.makedirs(screenshot_dir, exist_ok=True)
+        image_name = os.path.join(screenshot_dir, f'{name}.png')
         driver.save_screenshot(image_name)
 
     else:
@@ -137,7 +210,7 @@ def save_screenshot(driver, name):
         LOGGER.warning(msg)
 
 
-def save_driver_logs(driver, prefix):
+def save_driver_logs(driver, prefix, wait=True):
     """
     Save the selenium driver logs.
 
@@ -145,10 +218,18 @@ def save_driver_logs(driver, prefix):
     by the environment variable `SELENIUM_DRIVER_LOG_DIR`.  If not set,
     this defaults to the current working directory.
 
+    The different types of log are fetched and written concurrently.
+    Log types which the browser failed to provide once are skipped for
+    the rest of its lifetime.
+
     Args:
         driver (selenium.webdriver): The Selenium-controlled browser.
         prefix (str): A prefix which will be used in the output file names for the logs.
 
+    Keyword Args:
+        wait (bool): Whether to wait for the logs to be written before returning.  If False,
+            call `flush_driver_logs` to wait for them before quitting the browser.
+
     Returns:
         None
     """
@@ -157,8 +238,7 @@ def save_driver_logs(driver, prefix):
     if not log_dir:
         LOGGER.warning('The SELENIUM_DRIVER_LOG_DIR environment variable was not set; not saving logs')
         return
-    if not os.path.exists(log_dir):
-        os.makedirs(log_dir)
+    os.makedirs(log_dir, exist_ok=True)
     if browser_name == 'firefox':
         # Firefox doesn't yet provide logs to Selenium, but does log to a separate file
         # https://github.com/mozilla/geckodriver/issues/284
@@ -169,22 +249,83 @@ def save_driver_logs(driver, prefix):
             copyfile(log_path, dest_path)
         return
 
-    log_types = driver.log_types
-    for log_type in log_types:
-        try:
-            log = driver.get_log(log_type)
-            file_name = os.path.join(
-                log_dir, f'{prefix}_{log_type}.log'
-            )
-            with open(file_name, 'w', encoding="utf8") as output_file:
-                for line in log:
-                    output_file.write("{}{}".format(dumps(line), '\n'))
-        except:  # pylint: disable=bare-except
-            msg = (
-                f"Could not save browser log of type '{log_type}'. It may be that the browser does not support it."
-            )
+    unsupported = _UNSUPPORTED_LOG_TYPES.get(driver, set())
+    requests = []
+    for log_type in driver.log_types:
+        if log_type in unsupported:
+            continue
+        file_name = os.path.join(
+            log_dir, f'{prefix}_{log_type}.log'
+        )
+        requests.append(
+            (driver, log_type, _DRIVER_LOG_EXECUTOR.submit(_save_driver_log, driver, log_type, file_name))
+        )
+    if wait:
+        _wait_for_driver_logs(requests, DRIVER_LOG_TIMEOUT)
+    else:
+        with _PENDING_DRIVER_LOGS_LOCK:
+            _PENDING_DRIVER_LOGS.extend(requests)
+
+
+def flush_driver_logs(timeout=DRIVER_LOG_TIMEOUT):
+    """
+    Wait until all of the logs requested by `save_driver_logs` with `wait=False` have
+    been written, giving up on any the driver hasn't returned within `timeout` seconds.
+
+    A log type which times out isn't requested from that browser again.  Its
+    request can't be cancelled though; it keeps one of the few background
+    workers busy until the driver responds or is quit.
+
+    Keyword Args:
+        timeout (float): Seconds to wait, or None to wait indefinitely.
 
-            LOGGER.warning(msg, exc_info=True)
+    Returns:
+        None
+    """
+    with _PENDING_DRIVER_LOGS_LOCK:
+        pending = _PENDING_DRIVER_LOGS[:]
+        del _PENDING_DRIVER_LOGS[:]
+    _wait_for_driver_logs(pending, timeout)
+
+
+def _wait_for_driver_logs(requests, timeout):
+    """
+    Wait for the given (driver, log type, future) driver log requests, logging
+    and giving up on any which aren't done within `timeout` seconds.
+    """
+    _, not_done = futures.wait([future for _, _, future in requests], timeout=timeout)
+    timed_out = []
+    for driver, log_type, future in requests:
+        if future in not_done:
+            _UNSUPPORTED_LOG_TYPES.setdefault(driver, set()).add(log_type)
+            timed_out.append(log_type)
+    if timed_out:
+        LOGGER.warning(
+            "Timed out after %s seconds saving browser logs of types: %s", timeout, ", ".join(timed_out)
+        )
+
+
+def _save_driver_log(driver, log_type, file_name):
+    """
+    Fetch one type of selenium driver log and write it to the given file.
+    """
+    try:
+        log = driver.get_log(log_type)
+        with open(file_name, 'w', encoding="utf8") as output_file:
+            output_file.write("".join(f"{dumps(line)}\n" for line in log))
+    except WebDriverException:
+        _UNSUPPORTED_LOG_TYPES.setdefault(driver, set()).add(log_type)
+        msg = (
+            f"Could not save browser log of type '{log_type}'. It may be that the browser does not support it."
+        )
+
+        LOGGER.warning(msg, exc_info=True)
+    except OSError:
+        LOGGER.warning("Could not save browser log of type '%s' to %s.", log_type, file_name, exc_info=True)
+    except Exception:  # pylint: disable=broad-except
+        # This runs in a worker thread, so anything not logged here would be lost;
+        # e.g. urllib3 errors from a remote WebDriver server which has gone away
+        LOGGER.warning("Could not save browser log of type '%s'.", log_type, exc_info=True)
 
 
 def browser(tags=None, proxy=None, other_caps=None):
@@ -234,6 +375,13 @@ def browser(tags=None, proxy=None, other_caps=None):
     `tags` is a list of string tags to apply to the SauceLabs
     job.  If not using SauceLabs, these will be ignored.
 
+    Threads of one process launch browsers one at a time by default; the environment
+    variable `BOKCHOY_MAX_CONCURRENT_STARTUPS` can be set to allow more concurrent launches.
+
+    Browsers handed back with `release_browser` are reused by later calls made
+    with the same configuration, after clearing their cookies and navigating to
+    a blank page.  A reused SauceLabs session keeps the tags it was started with.
+
     Keyword Args:
         tags (list of str): Tags to apply to the SauceLabs job.  If not using SauceLabs, these will be ignored.
         proxy: A proxy instance.
@@ -250,6 +398,10 @@ def browser(tags=None, proxy=None, other_caps=None):
     """
 
     browser_name = os.environ.get('SELENIUM_BROWSER', 'firefox')
+    pool_key = _browser_pool_key(browser_name, proxy, other_caps)
+    pooled_browser = _pooled_browser(browser_name, pool_key)
+    if pooled_browser is not None:
+        return pooled_browser
 
     def browser_check_func():
         """ Instantiate the browser and return the browser instance """
@@ -257,10 +409,10 @@ def browser(tags=None, proxy=None, other_caps=None):
         try:
             # Get the class and kwargs required to instantiate the browser based on
             # whether we are using a local or remote one.
-            if _use_remote_browser(SAUCE_ENV_VARS):
+            if _use_remote_browser(_SAUCE_ENV_VAR_SET):
                 browser_class, browser_args, browser_kwargs = _remote_browser_class(
                     SAUCE_ENV_VARS, tags)
-            elif _use_remote_browser(REMOTE_ENV_VARS):
+            elif _use_remote_browser(_REMOTE_ENV_VAR_SET):
                 browser_class, browser_args, browser_kwargs = _remote_browser_class(
                     REMOTE_ENV_VARS, tags)
             else:
@@ -278,7 +430,8 @@ def browser(tags=None, proxy=None, other_caps=None):
                 desired_caps.update(browser_kwargs.get('desired_capabilities', {}))
                 browser_kwargs['desired_capabilities'] = desired_caps
 
-            return True, browser_class(*browser_args, **browser_kwargs)
+            with _STARTUP_SEMAPHORE:
+                return True, browser_class(*browser_args, **browser_kwargs)
 
         except (OSError, WebDriverException) as err:
             msg = str(err)
@@ -291,9 +444,120 @@ def browser(tags=None, proxy=None, other_caps=None):
         # be enforced.
         browser_check_func, "Browser is instantiated successfully.", try_limit=3, timeout=95).fulfill()
 
+    _BROWSER_POOL_KEYS[browser_instance] = pool_key
     return browser_instance
 
 
+def release_browser(driver):
+    """
+    Return a browser obtained from `browser` so that a later call can reuse it
+    instead of launching a new one.  Browsers which were not launched by
+    `browser`, or which failed to provide a driver log or may still be busy
+    fetching one, are simply quit.
+
+    Any browsers still idle when the Python process exits are quit then.
+
+    Args:
+        driver (selenium.webdriver): The Selenium-controlled browser.
+
+    Returns:
+        None
+    """
+    pool_key = _BROWSER_POOL_KEYS.get(driver)
+    reusable = pool_key is not None and not _awaiting_driver_logs(driver)
+    with _BROWSER_POOL_LOCK:
+        idle_browsers = _BROWSER_POOL.get(pool_key, [])
+        if any(idle_browser is driver for idle_browser in idle_browsers):
+            # Already released; pooling it twice would hand it to two callers
+            return
+        if reusable:
+            _BROWSER_POOL.setdefault(pool_key, []).append(driver)
+            return
+    driver.quit()
+
+
+def _awaiting_driver_logs(driver):
+    """
+    Returns whether the browser failed to provide a driver log or may still be
+    fetching one.  Reusing such a browser could block on the unanswered request.
+    """
+    with _PENDING_DRIVER_LOGS_LOCK:
+        pending = _PENDING_DRIVER_LOGS[:]
+    return driver in _UNSUPPORTED_LOG_TYPES or any(
+        pending_driver is driver and not future.done() for pending_driver, _, future in pending
+    )
+
+
+def _browser_pool_key(browser_name, proxy, other_caps):
+    """
+    Returns a hashable description of the browser configuration, used to
+    decide whether an idle pooled browser can be reused.
+    """
+    return (
+        browser_name,
+        tuple(os.environ.get(key) for key in _REMOTE_CONFIG_ENV_VARS),
+        tuple(os.environ.get(key) for key in _LOCAL_ENV_VARS),
+        tuple(FIREFOX_PROFILE_CUSTOMIZERS),
+        proxy.proxy if proxy else None,
+        dumps(other_caps or {}, sort_keys=True, default=str),
+    )
+
+
+def _pooled_browser(browser_name, pool_key):
+    """
+    Returns an idle pooled browser for the given configuration with its
+    state reset, or None if there isn't a usable one.
+    """
+    while True:
+        with _BROWSER_POOL_LOCK:
+            idle_browsers = _BROWSER_POOL.get(pool_key)
+            if not idle_browsers:
+                return None
+            driver = idle_browsers.pop()
+        try:
+            driver.delete_all_cookies()
+            driver.get('about:blank')
+        except (OSError, WebDriverException) as err:
+            LOGGER.debug('Discarding unresponsive pooled browser: %s', str(err))
+            _quit_browser(driver)
+            continue
+        if browser_name == 'firefox':
+            # Start a fresh geckodriver log for the next test, as a newly launched
+            # browser would.  geckodriver appends to the file, so it keeps logging
+            # to the truncated file rather than to an unlinked one.
+            log_path = os.path.join(os.getcwd(), 'geckodriver.log')
+            if os.path.exists(log_path):
+                os.truncate(log_path, 0)
+        return driver
+
+
+def _quit_browser(driver):
+    """
+    Quit the browser, ignoring any errors from one which has already gone away.
+    """
+    try:
+        driver.quit()
+    except (OSError, WebDriverException) as err:
+        LOGGER.debug('Failed to quit browser: %s', str(err))
+
+
+def _quit_pooled_browsers():
+    """
+    Quit all of the idle pooled browsers.
+    """
+    with _BROWSER_POOL_LOCK:
+        idle_browsers = [driver for drivers in _BROWSER_POOL.values() for driver in drivers]
+        _BROWSER_POOL.clear()
+    for driver in idle_browsers:
+        _quit_browser(driver)
+
+
+# Registered after _DRIVER_LOG_EXECUTOR, so that it runs before the executor joins its
+# workers at exit (threading._register_atexit callbacks run first, and both run in
+# reverse order); a pooled browser with a hung log request would otherwise block exit.
+getattr(threading, '_register_atexit', atexit.register)(_quit_pooled_browsers)
+
+
 def add_profile_customizer(func):
     """Add a new function that modifies the preferences of the firefox profile object it receives as an argument"""
     FIREFOX_PROFILE_CUSTOMIZERS.append(func)
@@ -374,12 +638,12 @@ def _local_browser_class(browser_name):
     LOGGER.info("Using local browser: %s [Default is firefox]", browser_name)
 
     # Get class of local browser based on name
-    browser_class = BROWSERS.get(browser_name)
-    headless = os.environ.get('BOKCHOY_HEADLESS', 'false').lower() == 'true'
-    if browser_class is None:
+    if browser_name not in _BROWSER_FACTORIES:
         raise BrowserConfigError(
-            f"Invalid browser name {browser_name}.  Options are: {', '.join(list(BROWSERS.keys()))}"
+            f"Invalid browser name {browser_name}.  Options are: {_BROWSERS_OPTIONS_STR}"
         )
+    browser_class = _browser_class(browser_name)
+    headless = os.environ.get('BOKCHOY_HEADLESS', 'false').lower() == 'true'
 
     if browser_name == 'firefox':
         # Remove geckodriver log data from previous test cases
@@ -433,6 +697,35 @@ def _local_browser_class(browser_name):
     return browser_class, browser_args, browser_kwargs
 
 
+def _browser_class(browser_name):
+    """
+    Returns the class for the named local browser, importing it on first use.
+    """
+    browser_class = _BROWSER_CLASSES.get(browser_name)
+    if browser_class is None:
+        class_name = _BROWSER_FACTORIES[browser_name]
+        try:
+            module = importlib.import_module('needle.driver')
+            class_name = f'Needle{class_name}'
+        except ImportError:
+            module = importlib.import_module('selenium.webdriver')
+        browser_class = _BROWSER_CLASSES[browser_name] = getattr(module, class_name)
+    return browser_class
+
+
+def __getattr__(name):
+    """
+    Builds the `BROWSERS` dict of local browser classes, keyed by browser name,
+    the first time it is accessed.
+    """
+    if name == 'BROWSERS':
+        browsers = globals()['BROWSERS'] = {
+            browser_name: _browser_class(browser_name) for browser_name in _BROWSER_FACTORIES
+        }
+        return browsers
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
 def _remote_browser_class(env_vars, tags=None):
     """
     Returns class, kwargs, and args needed to instantiate the remote browser.
@@ -462,6 +755,8 @@ def _remote_browser_class(env_vars, tags=None):
     browser_kwargs = {
         'command_executor': url,
         'desired_capabilities': caps,
+        # Reuse one HTTP connection for all of the session's commands
+        'keep_alive': True,
     }
     if caps['browserName'] == 'firefox':
         browser_kwargs['browser_profile'] = _firefox_profile()
@@ -469,7 +764,7 @@ def _remote_browser_class(env_vars, tags=None):
     return webdriver.Remote, browser_args, browser_kwargs
 
 
-def _proxy_kwargs(browser_name, proxy, browser_kwargs={}):  # pylint: disable=dangerous-default-value
+def _proxy_kwargs(browser_name, proxy, browser_kwargs=None):
     """
     Determines the kwargs needed to set up a proxy based on the
     browser type.
@@ -477,6 +772,8 @@ def _proxy_kwargs(browser_name, proxy, browser_kwargs={}):  # pylint: disable=da
     Returns: a dictionary of arguments needed to pass when
         instantiating the WebDriver instance.
     """
+    if browser_kwargs is None:
+        browser_kwargs = {}
 
     proxy_dict = {
         "httpProxy": proxy.proxy,
@@ -504,11 +801,10 @@ def _use_remote_browser(required_vars):
     browser.  This means the user has made an attempt to set
     environment variables indicating they want to connect to SauceLabs
     or a remote browser.
+
+    `required_vars` is a set of environment variable names.
     """
-    return all(
-        key in os.environ
-        for key in required_vars
-    )
+    return required_vars <= os.environ.keys()
 
 
 def _required_envs(env_vars):
@@ -532,7 +828,7 @@ def _required_envs(env_vars):
         raise BrowserConfigError(msg)
 
     # Check that we support this browser
-    if envs['SELENIUM_BROWSER'] not in BROWSERS:
+    if envs['SELENIUM_BROWSER'] not in _BROWSER_FACTORIES:
         msg = f"Unsuppported browser: {envs['SELENIUM_BROWSER']}"
         raise BrowserConfigError(msg)
 
@@ -571,19 +867,14 @@ def _capabilities_dict(envs, tags):
     `tags` is a list of string tags to apply to the SauceLabs job.
     """
     capabilities = {
+        **_BASE_CAPS,
         'browserName': envs['SELENIUM_BROWSER'],
         'acceptInsecureCerts': bool(envs.get('SELENIUM_INSECURE_CERTS', False)),
-        'video-upload-on-pass': False,
-        'sauce-advisor': False,
-        'capture-html': True,
-        'record-screenshots': True,
-        'max-duration': 600,
-        'public': 'public restricted',
         'tags': tags,
     }
 
     # Add SauceLabs specific environment vars if they are set.
-    if _use_remote_browser(SAUCE_ENV_VARS):
+    if _use_remote_browser(_SAUCE_ENV_VAR_SET):
         sauce_capabilities = {
             'platform': envs['SELENIUM_PLATFORM'],
             'version': envs['SELENIUM_VERSION'],
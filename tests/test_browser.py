@@ -6,12 +6,15 @@ import os
 import shutil
 import socket
 import tempfile
+import threading
+from concurrent import futures
 from unittest import TestCase
-from unittest.mock import patch
+from unittest.mock import MagicMock, patch
 
 import pytest
 from selenium import webdriver
 from selenium.common.exceptions import WebDriverException
+from urllib3.exceptions import MaxRetryError
 
 import bok_choy.browser
 from bok_choy.promise import BrokenPromise
@@ -77,6 +80,25 @@ class TestBrowser(TestCase):
         with self.assertRaises(bok_choy.browser.BrowserConfigError):
             bok_choy.browser.browser()
 
+    def test_local_browser_class(self):
+        browser_class = bok_choy.browser._local_browser_class('chrome')[0]  # pylint: disable=protected-access
+        self.assertTrue(issubclass(browser_class, webdriver.Chrome))
+        self.assertIs(bok_choy.browser.BROWSERS['chrome'], browser_class)
+        self.assertTrue(issubclass(bok_choy.browser.BROWSERS['firefox'], webdriver.Firefox))
+
+    @patch.dict(os.environ, {'SELENIUM_BROWSER': 'chrome', 'SELENIUM_HOST': '127.0.0.1'})
+    def test_use_remote_browser(self):
+        """
+        A remote browser should be used only when all of its environment variables are set.
+        """
+        # pylint: disable=protected-access
+        self.assertIsInstance(bok_choy.browser.REMOTE_ENV_VARS, list)
+        use_remote_browser = bok_choy.browser._use_remote_browser
+        self.assertFalse(use_remote_browser(bok_choy.browser._REMOTE_ENV_VAR_SET))
+        with patch.dict(os.environ, {'SELENIUM_PORT': '80'}):
+            self.assertTrue(use_remote_browser(bok_choy.browser._REMOTE_ENV_VAR_SET))
+            self.assertFalse(use_remote_browser(bok_choy.browser._SAUCE_ENV_VAR_SET))
+
     def test_profile_error(self):
         """
         If there is a WebDriverException when instantiating the driver,
@@ -143,6 +165,140 @@ class TestBrowser(TestCase):
         # browserName in other_caps should not have overriden env var mapping behavior
         self.assertEqual(desired_caps['browserName'], 'firefox')
         self.assertEqual(desired_caps['extra-data'], '1234')
+        self.assertTrue(patch_object.call_args[1]['keep_alive'])
+
+
+class TestBrowserPool(TestCase):
+    """ Tests for reusing browsers handed back with release_browser."""
+
+    @patch.dict(os.environ, {'SELENIUM_BROWSER': 'chrome'})
+    def test_released_browser_reused(self):
+        """
+        A released browser should be reset and reused for the same configuration only.
+        """
+        browser_class = patch('bok_choy.browser._local_browser_class').start()
+        browser_class.return_value = (MagicMock, [], {})
+        self.addCleanup(patch.stopall)
+        self.addCleanup(bok_choy.browser._BROWSER_POOL.clear)  # pylint: disable=protected-access
+        browser = bok_choy.browser.browser()
+        bok_choy.browser.release_browser(browser)
+        browser.quit.assert_not_called()
+
+        with patch.dict(os.environ, {'BOKCHOY_HEADLESS': 'true'}):
+            self.assertIsNot(bok_choy.browser.browser(), browser)
+
+        self.assertIs(bok_choy.browser.browser(), browser)
+        browser.delete_all_cookies.assert_called_once_with()
+        browser.get.assert_called_once_with('about:blank')
+        self.assertIsNot(bok_choy.browser.browser(), browser)
+
+    @patch.dict(os.environ, {'SELENIUM_BROWSER': 'chrome'})
+    def test_released_browser_not_shared(self):
+        """
+        A browser released twice, or launched before a profile customizer
+        was added, shouldn't be handed out again.
+        """
+        browser_class = patch('bok_choy.browser._local_browser_class').start()
+        browser_class.return_value = (MagicMock, [], {})
+        self.addCleanup(patch.stopall)
+        self.addCleanup(bok_choy.browser._BROWSER_POOL.clear)  # pylint: disable=protected-access
+        browser = bok_choy.browser.browser()
+        bok_choy.browser.release_browser(browser)
+        bok_choy.browser.release_browser(browser)
+        self.assertIs(bok_choy.browser.browser(), browser)
+        self.assertIsNot(bok_choy.browser.browser(), browser)
+
+        bok_choy.browser.release_browser(browser)
+        bok_choy.browser.add_profile_customizer(lambda profile: None)
+        self.addCleanup(bok_choy.browser.clear_profile_customizers)
+        self.assertIsNot(bok_choy.browser.browser(), browser)
+
+    @patch.dict(os.environ, {'SELENIUM_BROWSER': 'chrome'})
+    def test_released_browser_awaiting_logs_quit(self):
+        """
+        A browser which may still be busy with a driver log request shouldn't be pooled.
+        """
+        browser_class = patch('bok_choy.browser._local_browser_class').start()
+        browser_class.return_value = (MagicMock, [], {})
+        self.addCleanup(patch.stopall)
+        self.addCleanup(bok_choy.browser._BROWSER_POOL.clear)  # pylint: disable=protected-access
+        failed_browser = bok_choy.browser.browser()
+        bok_choy.browser._UNSUPPORTED_LOG_TYPES[failed_browser] = {'browser'}  # pylint: disable=protected-access
+        bok_choy.browser.release_browser(failed_browser)
+        failed_browser.quit.assert_called_once_with()
+
+        busy_browser = bok_choy.browser.browser()
+        pending = [(busy_browser, 'browser', futures.Future())]
+        with patch.object(bok_choy.browser, '_PENDING_DRIVER_LOGS', pending):
+            bok_choy.browser.release_browser(busy_browser)
+        busy_browser.quit.assert_called_once_with()
+        self.assertIsNot(bok_choy.browser.browser(), busy_browser)
+
+    @patch.dict(os.environ, {'SELENIUM_BROWSER': 'firefox'})
+    def test_released_firefox_log_truncated(self):
+        """
+        Reusing a local Firefox should start a new geckodriver log for the next test.
+        """
+        browser_class = patch('bok_choy.browser._local_browser_class').start()
+        browser_class.return_value = (MagicMock, [], {})
+        self.addCleanup(patch.stopall)
+        self.addCleanup(bok_choy.browser._BROWSER_POOL.clear)  # pylint: disable=protected-access
+        log_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, log_dir)
+        log_path = os.path.join(log_dir, 'geckodriver.log')
+        with open(log_path, 'w', encoding='utf8') as log_file:
+            log_file.write('previous test')
+        patch('os.getcwd', return_value=log_dir).start()
+        bok_choy.browser.release_browser(bok_choy.browser.browser())
+        bok_choy.browser.browser()
+        self.assertEqual(os.path.getsize(log_path), 0)
+
+
+class TestBrowserStartup(TestCase):
+    """ Tests for limiting how many browsers are launched at once."""
+
+    @patch.dict(os.environ, {'SELENIUM_BROWSER': 'chrome'})
+    def test_browser_startup_serialized(self):
+        """
+        Browsers should be launched while holding the startup semaphore.
+        """
+        semaphore = patch.object(bok_choy.browser, '_STARTUP_SEMAPHORE').start()
+        browser_class = MagicMock(side_effect=lambda: MagicMock(started_in_semaphore=semaphore.__enter__.called))
+        patch('bok_choy.browser._local_browser_class', return_value=(browser_class, [], {})).start()
+        self.addCleanup(patch.stopall)
+        self.assertTrue(bok_choy.browser.browser().started_in_semaphore)
+        semaphore.__exit__.assert_called_once()
+
+    def test_max_concurrent_startups(self):
+        """
+        An invalid concurrent startup limit should fall back to one browser at a time.
+        """
+        max_concurrent_startups = bok_choy.browser._max_concurrent_startups  # pylint: disable=protected-access
+        with patch.dict(os.environ, {'BOKCHOY_MAX_CONCURRENT_STARTUPS': '3'}):
+            self.assertEqual(max_concurrent_startups(), 3)
+        for value in ('many', '0', '-2', ''):
+            with patch.dict(os.environ, {'BOKCHOY_MAX_CONCURRENT_STARTUPS': value}):
+                with self.assertLogs('bok_choy.browser', level='WARNING') as logs:
+                    self.assertEqual(max_concurrent_startups(), 1)
+            self.assertIn(f'must be a positive integer, not {value!r}', logs.output[0])
+
+
+class TestProxyKwargs(TestCase):
+    """ Tests for the kwargs which configure a browser's proxy."""
+
+    def test_proxy_kwargs_not_shared(self):
+        """
+        Proxy settings for one browser shouldn't leak into the kwargs for another.
+        """
+        proxy_kwargs = bok_choy.browser._proxy_kwargs  # pylint: disable=protected-access
+        chrome_kwargs = proxy_kwargs('chrome', MagicMock(proxy='localhost:8080'))
+        self.assertEqual(
+            chrome_kwargs['desired_capabilities']['proxy'],
+            {'proxyType': 'manual', 'httpProxy': 'localhost:8080'}
+        )
+        firefox_kwargs = proxy_kwargs('firefox', MagicMock(proxy='localhost:9090'))
+        self.assertNotIn('desired_capabilities', firefox_kwargs)
+        self.assertEqual(firefox_kwargs['proxy'].http_proxy, 'localhost:9090')
 
 
 class TestFirefoxBrowserConfig(TestCase):
@@ -293,7 +449,7 @@ class TestSaveFiles:
         # Configure the driver log directory using an environment variable
         os.environ['SELENIUM_DRIVER_LOG_DIR'] = tempdir_path
         JavaScriptPage(browser).visit()
-        with patch.object(browser, 'get_log', side_effect=Exception):
+        with patch.object(browser, 'get_log', side_effect=WebDriverException):
             bok_choy.browser.save_driver_logs(browser, 'js_page')
 
         # Check that no files were created.
@@ -339,3 +495,101 @@ class TestSaveFiles:
         expected_file = os.path.join(self.tempdir_path, 'button_page.html')
         assert not os.path.exists(expected_file)
         assert 'Could not save the browser page source' in caplog.text
+
+
+class TestSaveDriverLogs(TestCase):
+    """
+    Tests for fetching and writing the driver logs in the background.
+    """
+
+    def test_save_driver_logs_in_background(self):
+        """
+        Driver logs should be written once flushed, one JSON entry per line.
+        """
+        log_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, log_dir)
+        driver = MagicMock(log_types=['browser', 'driver'])
+        driver.get_log.side_effect = lambda log_type: [{'type': log_type}, {'index': 2}]
+        with patch.dict(os.environ, {'SELENIUM_BROWSER': 'chrome', 'SELENIUM_DRIVER_LOG_DIR': log_dir}):
+            bok_choy.browser.save_driver_logs(driver, 'mock', wait=False)
+        bok_choy.browser.flush_driver_logs()
+        for log_type in driver.log_types:
+            with open(os.path.join(log_dir, f'mock_{log_type}.log'), encoding='utf8') as log_file:
+                self.assertEqual(log_file.read(), f'{{"type": "{log_type}"}}\n{{"index": 2}}\n')
+
+    def test_save_driver_logs_skips_unsupported(self):
+        """
+        A log type which the driver failed to provide shouldn't be requested from it again.
+        """
+        log_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, log_dir)
+        driver = MagicMock(log_types=['browser', 'server'])
+        driver.get_log.side_effect = lambda log_type: [] if log_type == 'browser' else driver.get_log.fail()
+        driver.get_log.fail.side_effect = WebDriverException
+        with patch.dict(os.environ, {'SELENIUM_BROWSER': 'chrome', 'SELENIUM_DRIVER_LOG_DIR': log_dir}):
+            for _ in range(2):
+                bok_choy.browser.save_driver_logs(driver, 'mock')
+        self.assertEqual([call.args[0] for call in driver.get_log.call_args_list], ['browser', 'server', 'browser'])
+
+    def test_save_driver_logs_other_error(self):
+        """
+        Errors other than WebDriverException from fetching a log should still be logged.
+        """
+        log_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, log_dir)
+        driver = MagicMock(log_types=['browser'])
+        driver.get_log.side_effect = MaxRetryError(None, '/session/1/log', 'hub is gone')
+        with patch.dict(os.environ, {'SELENIUM_BROWSER': 'chrome', 'SELENIUM_DRIVER_LOG_DIR': log_dir}):
+            with self.assertLogs('bok_choy.browser', level='WARNING') as logs:
+                bok_choy.browser.save_driver_logs(driver, 'mock')
+        self.assertIn("Could not save browser log of type 'browser'.", logs.output[0])
+        self.assertIn('MaxRetryError', logs.output[0])
+        self.assertFalse(os.path.exists(os.path.join(log_dir, 'mock_browser.log')))
+
+    def test_flush_driver_logs_timeout(self):
+        """
+        Waiting for driver logs should give up on a driver which doesn't respond,
+        and not request the same log type from it again.
+        """
+        log_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, log_dir)
+        responded = threading.Event()
+        driver = MagicMock(log_types=['browser'])
+        driver.get_log.side_effect = lambda log_type: responded.wait() and []
+        with patch.dict(os.environ, {'SELENIUM_BROWSER': 'chrome', 'SELENIUM_DRIVER_LOG_DIR': log_dir}):
+            bok_choy.browser.save_driver_logs(driver, 'mock', wait=False)
+        # Cleanups run in reverse: let the request finish writing its log before removing the directory
+        pending = bok_choy.browser._PENDING_DRIVER_LOGS  # pylint: disable=protected-access
+        self.addCleanup(futures.wait, [future for _, _, future in pending])
+        self.addCleanup(responded.set)
+        with self.assertLogs('bok_choy.browser', level='WARNING') as logs:
+            bok_choy.browser.flush_driver_logs(timeout=0.1)
+        self.assertIn('Timed out after 0.1 seconds saving browser logs of types: browser', logs.output[0])
+
+        with patch.dict(os.environ, {'SELENIUM_BROWSER': 'chrome', 'SELENIUM_DRIVER_LOG_DIR': log_dir}):
+            bok_choy.browser.save_driver_logs(driver, 'mock', wait=False)
+        driver.get_log.assert_called_once_with('browser')
+
+    def test_save_driver_logs_waits_for_own_logs(self):
+        """
+        Waiting for one browser's logs shouldn't wait for, or take over, logs requested without waiting.
+        """
+        log_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, log_dir)
+        self.addCleanup(bok_choy.browser.flush_driver_logs, timeout=None)
+        responded = threading.Event()
+        self.addCleanup(responded.set)
+        hung_driver = MagicMock(log_types=['browser'])
+        hung_driver.get_log.side_effect = lambda log_type: responded.wait() and []
+        driver = MagicMock(log_types=['browser'])
+        driver.get_log.return_value = [{'index': 1}]
+        with patch.dict(os.environ, {'SELENIUM_BROWSER': 'chrome', 'SELENIUM_DRIVER_LOG_DIR': log_dir}):
+            bok_choy.browser.save_driver_logs(hung_driver, 'hung', wait=False)
+            bok_choy.browser.save_driver_logs(driver, 'mock')
+        with open(os.path.join(log_dir, 'mock_browser.log'), encoding='utf8') as log_file:
+            self.assertEqual(log_file.read(), '{"index": 1}\n')
+        self.assertNotIn(hung_driver, bok_choy.browser._UNSUPPORTED_LOG_TYPES)  # pylint: disable=protected-access
+
+        responded.set()
+        bok_choy.browser.flush_driver_logs(timeout=None)
+        self.assertTrue(os.path.exists(os.path.join(log_dir, 'hung_browser.log')))